@@ -1,19 +1,58 @@
 # coding: utf-8
 
+import hashlib
+import io
 import json
 import logging
 import os
+import shutil
 import tarfile
-from dataclasses import dataclass, asdict
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path, PurePosixPath
 
+# Must be set before `huggingface_hub` is imported, as it reads it at import time
+os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
 import requests
-from huggingface_hub import HfApi
+from huggingface_hub import (
+    CommitOperationAdd,
+    HfApi,
+    hf_hub_download,
+    hf_hub_url,
+    try_to_load_from_cache,
+)
+from huggingface_hub.hf_api import RepoFile
+from huggingface_hub.utils import HfHubHTTPError
 from invoke import task
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 _LOGGER = logging.getLogger("piper.rt")
 HF_CLIENT = HfApi()
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(total=5, backoff_factor=0.5),
+    )
+)
+HTTP_TIMEOUT = (5, 60)
+MAX_WORKERS = 4
+COMMIT_BATCH_SIZE = 16
+TAR_COPY_BUFSIZE = 2 * 1024 * 1024
+EXPORT_TMPFS_DIR = "/dev/shm"
+# Generous room per worker, since each may hold an export while packaging overlaps the next one
+EXPORT_TMPFS_MIN_FREE = MAX_WORKERS * 512 * 1024 * 1024
+# Serializes the ONNX export (GPU memory) and guards `c.cd`,
+# which mutates state shared by all threads on the invoke context
+_EXPORT_SEMAPHORE = threading.Semaphore(1)
 PIPER_CHECKPOINTS_DATASET = "rhasspy/piper-checkpoints"
 RT_VOICES_DATASET = "mush42/piper-rt"
 CHECKPOINTS_URL_PREFIX = "https://huggingface.co/datasets/rhasspy/piper-checkpoints/resolve/main/{}"
@@ -28,124 +67,236 @@ class Voice:
     etag: str
 
 
-def get_updated_voices(voices):
-    metadata_response = requests.get(VOICES_URL_PREFIX.format("metadata.json"))
-    if metadata_response.status_code == 401:
+def get_json_cached(url, cache_filename):
+    etag_filename = cache_filename.with_name(f"{cache_filename.name}.etag")
+    headers = {}
+    if cache_filename.is_file() and etag_filename.is_file():
+        headers["If-None-Match"] = etag_filename.read_text(encoding="utf-8")
+    response = SESSION.get(url, headers=headers, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    if response.status_code == 304:
+        _LOGGER.info(f"{cache_filename.name} unchanged. Using cached copy.")
+        return json.loads(cache_filename.read_text(encoding="utf-8"))
+    cache_filename.write_bytes(response.content)
+    if etag := response.headers.get("ETag"):
+        etag_filename.write_text(etag, encoding="utf-8")
+    else:
+        # A stale etag would revalidate the new body against the old one
+        etag_filename.unlink(missing_ok=True)
+    return response.json()
+
+
+def get_updated_voices(voices, working_dir):
+    try:
+        metadata = get_json_cached(
+            VOICES_URL_PREFIX.format("metadata.json"),
+            working_dir.joinpath(".metadata.json")
+        )
+    except requests.HTTPError as e:
+        if e.response.status_code != 401:
+            raise
         _LOGGER.info("No existing metadata file. Starting from scratch...")
         return voices
-    metadata_response.raise_for_status()
-    processed_voices = [
-        Voice(**d)
-        for d in metadata_response.json()
+    processed_keys = frozenset(
+        (d["config"], d["checkpoint"], d["etag"])
+        for d in metadata
+    )
+    return [
+        v
+        for v in voices
+        if (v.config, v.checkpoint, v.etag) not in processed_keys
     ]
-    retval = []
-    for v in voices:
-        already_processed = any([
-            (p.config == v.config) and (p.checkpoint == v.checkpoint) and (p.etag == v.etag)
-            for p in processed_voices
-        ])
-        if already_processed:
-            continue
-        retval.append(v)
-    return retval
 
 
-def export_and_package(c, voice, export_script_path, working_dir):
-    export_dir = working_dir.joinpath("exported")
-    export_dir.mkdir(parents=True, exist_ok=True)
-    checkpoint_url = CHECKPOINTS_URL_PREFIX.format(voice.checkpoint)
-    _LOGGER.info("Downloading checkpoint...")
-    checkpoint_response = requests.get(checkpoint_url)
-    checkpoint_response.raise_for_status()
-    downloaded_checkpoint_filename = working_dir.joinpath("checkpoint.ckpt")
-    downloaded_checkpoint_filename.write_bytes(checkpoint_response.content)
-    _LOGGER.info("Exporting to ONNX.")
-    with c.cd(export_script_path):
-        export_cmd = " ".join([
-            "python3 -m piper_train.export_onnx_streaming --debug",
-            os.fspath(downloaded_checkpoint_filename),
-            os.fspath(export_dir),
-        ])
-        c.run(export_cmd)
-    # Config
-    _LOGGER.info("Preparing config.")
-    config_url = CHECKPOINTS_URL_PREFIX.format(voice.config)
-    config_json = requests.get(config_url).json()
-    config_json["streaming"] = True
+def get_export_tmp_root(working_dir):
+    # Export to tmpfs only when it has room, e.g. docker defaults to a 64 MiB /dev/shm
+    if os.path.isdir(EXPORT_TMPFS_DIR):
+        if shutil.disk_usage(EXPORT_TMPFS_DIR).free >= EXPORT_TMPFS_MIN_FREE:
+            return Path(EXPORT_TMPFS_DIR)
+        _LOGGER.info(f"Not enough free space in {EXPORT_TMPFS_DIR}. Exporting to the workspace.")
+    export_tmp_root = working_dir.joinpath("exports")
+    export_tmp_root.mkdir(parents=True, exist_ok=True)
+    return export_tmp_root
+
+
+def evict_cached_checkpoint(voice, hf_cache_dir):
+    cached_checkpoint = try_to_load_from_cache(
+        PIPER_CHECKPOINTS_DATASET,
+        os.fspath(voice.checkpoint),
+        cache_dir=hf_cache_dir,
+        repo_type="dataset",
+    )
+    if not isinstance(cached_checkpoint, str):
+        return
+    checkpoint_filename = Path(cached_checkpoint)
+    checkpoint_blob = checkpoint_filename.resolve()
+    checkpoint_filename.unlink()
+    checkpoint_blob.unlink(missing_ok=True)
+
+
+def export_and_package(c, voice, export_script_path, hf_cache_dir, packages_dir, export_tmp_root):
     voice_name_parts = voice.name.split("-")
     new_name = "-".join([
         voice_name_parts[0],
         f"{voice_name_parts[1]}+RT",
         voice_name_parts[2]
     ])
-    config_json["key"] = new_name
-    export_dir.joinpath(f"{new_name}.json").write_text(
-        json.dumps(config_json, indent=2, ensure_ascii=False),
-        encoding="utf-8",
-        newline="\n"
-    )
-    _LOGGER.info("Packaging voice...")
-    package_filename = working_dir.joinpath(f"{new_name}.tar.gz")
-    with tarfile.TarFile(package_filename, "w") as pack:
-        for file in export_dir.iterdir():
-            pack.add(os.fspath(file.resolve()), arcname=file.name)
-    # Upload to hf-hub
-    _LOGGER.info("Uploading voice...")
-    HF_CLIENT.upload_file(
-        path_or_fileobj=package_filename,
-        path_in_repo=package_filename.name,
+    # Keyed by checkpoint etag, so a package left over by a failed upload is reused only if still current
+    package_filename = packages_dir.joinpath(voice.etag, f"{new_name}.tar.gz")
+    if package_filename.is_file():
+        _LOGGER.info("Reusing package from a previous run.")
+        return package_filename
+    _LOGGER.info("Downloading checkpoint...")
+    downloaded_checkpoint_filename = Path(hf_hub_download(
+        repo_id=PIPER_CHECKPOINTS_DATASET,
+        filename=os.fspath(voice.checkpoint),
+        repo_type="dataset",
+        cache_dir=hf_cache_dir,
+    ))
+    with tempfile.TemporaryDirectory(dir=export_tmp_root) as export_dir_name:
+        export_dir = Path(export_dir_name)
+        _LOGGER.info("Exporting to ONNX.")
+        export_cmd = " ".join([
+            "python3 -m piper_train.export_onnx_streaming --debug",
+            os.fspath(downloaded_checkpoint_filename),
+            os.fspath(export_dir),
+        ])
+        with _EXPORT_SEMAPHORE, c.cd(export_script_path):
+            c.run(export_cmd)
+        # Config
+        _LOGGER.info("Preparing config.")
+        config_url = CHECKPOINTS_URL_PREFIX.format(voice.config)
+        config_json = SESSION.get(config_url, timeout=HTTP_TIMEOUT).json()
+        config_json["streaming"] = True
+        config_json["key"] = new_name
+        export_dir.joinpath(f"{new_name}.json").write_text(
+            json.dumps(config_json, indent=2, ensure_ascii=False),
+            encoding="utf-8",
+            newline="\n"
+        )
+        _LOGGER.info("Packaging voice...")
+        package_filename.parent.mkdir(parents=True, exist_ok=True)
+        # Write under a temporary name, so an interrupted run never leaves a partial package to reuse
+        partial_package_filename = package_filename.with_name(f"{package_filename.name}.partial")
+        with tarfile.open(
+            partial_package_filename,
+            "w:gz",
+            compresslevel=6,
+            copybufsize=TAR_COPY_BUFSIZE
+        ) as pack:
+            with os.scandir(export_dir) as entries:
+                for entry in entries:
+                    pack.add(entry.path, arcname=entry.name)
+        os.replace(partial_package_filename, package_filename)
+    # The package is kept until uploaded, so the checkpoint is no longer needed;
+    # release its disk space and page cache now rather than at the end of the run
+    evict_cached_checkpoint(voice, hf_cache_dir)
+    return package_filename
+
+
+def _safe_export(c, voice, export_script_path, hf_cache_dir, packages_dir, export_tmp_root):
+    _LOGGER.info(f"Processing voice: {voice.name}")
+    try:
+        return export_and_package(
+            c, voice, export_script_path, hf_cache_dir, packages_dir, export_tmp_root
+        )
+    except:
+        _LOGGER.error(f"Failed to export and package voice: {voice.name}", exc_info=True)
+
+
+def commit_packages(package_filenames, extra_operations=()):
+    operations = [
+        CommitOperationAdd(
+            path_in_repo=package_filename.name,
+            path_or_fileobj=package_filename,
+        )
+        for package_filename in package_filenames
+    ]
+    operations.extend(extra_operations)
+    if not operations:
+        return
+    changes = []
+    if package_filenames:
+        changes.append(f"Add {len(package_filenames)} voices")
+    if extra_operations:
+        changes.append("Update " + ", ".join(op.path_in_repo for op in extra_operations))
+    commit_message = "; ".join(changes)
+    _LOGGER.info(f"Uploading: {commit_message}")
+    HF_CLIENT.create_commit(
         repo_id=RT_VOICES_DATASET,
         repo_type="dataset",
+        operations=operations,
+        commit_message=commit_message,
     )
-    # Cleanup
-    _LOGGER.info("Cleaning up...")
-    with c.cd(working_dir):
-        c.run("rm -rf *")
+    # Only drop the packages once uploaded, so a failed commit can be retried without exporting again
+    for package_filename in package_filenames:
+        shutil.rmtree(package_filename.parent, ignore_errors=True)
 
 
-def dump_voices_metadata(voices, working_dir):
+def commit_operation_if_changed(path_in_repo, content):
+    # The hub reports the git blob id of non-LFS files as their etag
+    git_blob_id = hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+    try:
+        remote_metadata = HF_CLIENT.get_hf_file_metadata(
+            url=hf_hub_url(RT_VOICES_DATASET, path_in_repo, repo_type="dataset")
+        )
+    except HfHubHTTPError:
+        remote_metadata = None
+    if (remote_metadata is not None) and (remote_metadata.etag == git_blob_id):
+        _LOGGER.info(f"Remote {path_in_repo} is up to date. Skipping upload.")
+        return None
+    return CommitOperationAdd(
+        path_in_repo=path_in_repo,
+        path_or_fileobj=io.BytesIO(content),
+    )
+
+
+def dump_voices_metadata(voices, updated_voices, working_dir):
+    if not updated_voices:
+        _LOGGER.info("No new voices. Skipping metadata update.")
+        return []
     _LOGGER.info("Dumping voice metadata.")
     dst_json_filename = working_dir.joinpath("metadata.json")
+    # `Voice` has no nested dataclasses, so skip the deep copy made by `asdict`
     processed_voices = [
-        asdict(voice)
+        vars(voice)
         for voice in voices
     ]
     with open(dst_json_filename, "w", encoding="utf-8", newline="\n") as file:
         json.dump(processed_voices, file, indent=2, ensure_ascii=False)
-    HF_CLIENT.upload_file(
-        path_or_fileobj=dst_json_filename,
-        path_in_repo=dst_json_filename.name,
-        repo_id=RT_VOICES_DATASET,
-        repo_type="dataset",
-    )
+    operations = [
+        commit_operation_if_changed(dst_json_filename.name, dst_json_filename.read_bytes())
+    ]
     # Add a proper voices.json
-    piper_voices = requests.get(
-        "https://huggingface.co/rhasspy/piper-voices/resolve/main/voices.json"
-    ).json()
-    std_voice_names = frozenset([v["name"] for v in processed_voices])
+    piper_voices = get_json_cached(
+        "https://huggingface.co/rhasspy/piper-voices/resolve/main/voices.json",
+        working_dir.joinpath(".piper_voices.json")
+    )
+    std_voice_names = {v.name for v in voices}
     rt_voices = {}
-    for (vname, vdata) in piper_voices.items():
-        if vname in std_voice_names:
-            lang, name, quality = vname.split("-")
-            new_name = "-".join([
-                lang,
-                f"{name}+RT",
-                quality
-            ])
-            vdata["base"] = vdata["key"]
-            vdata["key"] = new_name
-            vdata["streaming"] = True
-            vdata["files"] = [f"{new_name}.tar.gz"]
-            rt_voices[new_name] = vdata
+    for vname in sorted(std_voice_names & piper_voices.keys()):
+        lang, name, quality = vname.split("-")
+        new_name = "-".join([
+            lang,
+            f"{name}+RT",
+            quality
+        ])
+        rt_voices[new_name] = {
+            **piper_voices[vname],
+            "base": piper_voices[vname]["key"],
+            "key": new_name,
+            "streaming": True,
+            "files": [f"{new_name}.tar.gz"],
+        }
     voices_dst_filename = working_dir.joinpath("voices.json")
     with open(voices_dst_filename, "w", encoding="utf-8", newline="\n") as voices_file:
         json.dump(rt_voices, voices_file, indent=2, ensure_ascii=False)
-    HF_CLIENT.upload_file(
-        path_or_fileobj=voices_dst_filename,
-        path_in_repo=voices_dst_filename.name,
-        repo_id=RT_VOICES_DATASET,
-        repo_type="dataset",
-    )
+    # Upload a compact copy, since consumers download this file frequently
+    operations.append(commit_operation_if_changed(
+        voices_dst_filename.name,
+        json.dumps(rt_voices, separators=(",", ":"), ensure_ascii=True).encode("ascii")
+    ))
+    return [op for op in operations if op is not None]
 
 
 @task
@@ -168,46 +319,86 @@ def run(c):
     export_script_path = Path.cwd().joinpath("piper", "src", "python")
     working_dir = Path.cwd().joinpath("workspace")
     working_dir.mkdir(parents=True, exist_ok=True)
-    all_files = HF_CLIENT.list_repo_files(
+    repo_tree = HF_CLIENT.list_repo_tree(
         PIPER_CHECKPOINTS_DATASET,
-        repo_type="dataset"
-    )
-    files = [PurePosixPath(path) for path in all_files]
-    config_files = filter(
-        lambda f: f.name == 'config.json',
-        files
+        repo_type="dataset",
+        recursive=True,
     )
+    # Only config files and checkpoints are relevant, so filter the paginated listing as it streams in
+    etag_by_path = {}
+    files_by_dir = defaultdict(list)
+    for entry in repo_tree:
+        if not isinstance(entry, RepoFile):
+            continue
+        file = PurePosixPath(entry.path)
+        if (file.name != "config.json") and (file.suffix != ".ckpt"):
+            continue
+        # Match the etag reported by `get_hf_file_metadata`: the sha256 for LFS files, the git OID otherwise
+        etag_by_path[entry.path] = entry.lfs.sha256 if entry.lfs else entry.blob_id
+        files_by_dir[file.parent].append(file)
     voices = []
-    for cfg_file in config_files:
-        voice_name = "-".join(cfg_file.parent.parts[1:])
-        try:
-            checkpoint_file = next(filter(
-                lambda f: (f.parent == cfg_file.parent) and f.suffix == ".ckpt",
-                files
-            ))
-        except StopIteration:
+    for (voice_dir, dir_files) in files_by_dir.items():
+        if not any(f.name == "config.json" for f in dir_files):
             continue
-        file_metadata = HF_CLIENT.get_hf_file_metadata(
-            url=CHECKPOINTS_URL_PREFIX.format(checkpoint_file)
+        cfg_file = voice_dir.joinpath("config.json")
+        voice_name = "-".join(voice_dir.parts[1:])
+        checkpoint_file = next(
+            (f for f in dir_files if f.suffix == ".ckpt"),
+            None
         )
+        if checkpoint_file is None:
+            continue
         voice = Voice(
             name=voice_name,
             config=os.fspath(cfg_file),
             checkpoint=os.fspath(checkpoint_file),
-            etag=file_metadata.etag
+            etag=etag_by_path[os.fspath(checkpoint_file)]
         )
         voices.append(voice)
-    updated_voices = get_updated_voices(voices)
+    updated_voices = get_updated_voices(voices, working_dir)
     _LOGGER.info(f"Found {len(updated_voices)} new voices")
     # Export and package
-    for voice in updated_voices:
-        _LOGGER.info(f"Processing voice: {voice.name}")
-        try:
-            export_and_package(c, voice, export_script_path, working_dir)
-        except:
-            _LOGGER.error("Failed to export and package voice", exc_info=True)
-            continue
-    # Dump metadata for later reference
-    dump_voices_metadata(voices, working_dir)
+    packages_dir = working_dir.joinpath("packages")
+    packages_dir.mkdir(parents=True, exist_ok=True)
+    export_tmp_root = get_export_tmp_root(working_dir)
+    hf_cache_dir = working_dir.joinpath(".hf-cache")
+    # Upload to hf-hub in batches as packages become available, instead of holding all of them until the end
+    pending_voices = []
+    pending_package_filenames = []
+    # Not recorded as processed, so the next run retries them (reusing their cached checkpoints or packages)
+    failed_voice_names = set()
+    upload_failed = False
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        package_filenames = executor.map(
+            lambda v: _safe_export(
+                c, v, export_script_path, hf_cache_dir, packages_dir, export_tmp_root
+            ),
+            updated_voices
+        )
+        for (voice, package_filename) in zip(updated_voices, package_filenames):
+            if package_filename is None:
+                failed_voice_names.add(voice.name)
+                continue
+            pending_voices.append(voice)
+            pending_package_filenames.append(package_filename)
+            if len(pending_package_filenames) >= COMMIT_BATCH_SIZE:
+                # Raising here would block until every remaining voice is exported
+                try:
+                    commit_packages(pending_package_filenames)
+                except Exception:
+                    _LOGGER.error("Failed to upload voices. Keeping their packages for the next run", exc_info=True)
+                    failed_voice_names.update(v.name for v in pending_voices)
+                    upload_failed = True
+                pending_voices = []
+                pending_package_filenames = []
+    # Dump metadata for later reference, committed along with the last batch
+    processed_voices = [v for v in voices if v.name not in failed_voice_names]
+    commit_packages(
+        pending_package_filenames,
+        dump_voices_metadata(processed_voices, updated_voices, working_dir)
+    )
+    # Also drops stale packages left over by earlier failed runs
+    if not upload_failed:
+        shutil.rmtree(packages_dir, ignore_errors=True)
     _LOGGER.info("Process Done")
 